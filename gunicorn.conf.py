@@ -0,0 +1,29 @@
+"""Gunicorn config: prefork workers sharing preloaded model weights.
+
+Pair this with TORCH_NUM_THREADS so that workers * threads-per-worker
+roughly equals the physical core count, otherwise the workers' intra-op
+pools oversubscribe the CPU.
+"""
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = 2
+# Load the app (and the default Florence-2 model) in the master before
+# forking so workers share the weight pages copy-on-write
+preload_app = True
+# Model loads and long generations can exceed the default 30s
+timeout = 300
+
+
+def post_fork(server, worker):
+    """Pin each worker to a disjoint core set so their torch thread pools
+    don't fight over the same CPUs."""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // server.cfg.workers)
+    index = (worker.age - 1) % server.cfg.workers
+    assigned = cores[index * per_worker:(index + 1) * per_worker] or cores
+    os.sched_setaffinity(0, set(assigned))
@@ -0,0 +1,13 @@
+"""Gunicorn entry point.
+
+create_app() runs at import time, so with --preload (set in
+gunicorn.conf.py) the master process loads Florence-2 once and the forked
+workers share the weight pages copy-on-write instead of each holding a
+private copy.
+
+Run with:
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from server import create_app
+
+app = create_app()